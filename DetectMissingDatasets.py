@@ -20,7 +20,8 @@ to create datasets.
 The program also creates a logging file called 'missing_submitter_ids.json'. 
 This file contains every submitter ID that is missing from the Xena hub, as
 well as ones removed from the GDC. They are organized by project ID and the 
-dataset they belong to. 
+dataset they belong to, with one JSON object per project on each line at 
+the end of the file. 
 
 Usage Instructions:
 
@@ -39,34 +40,88 @@ To run the script on an individual project:
 Example:
 	python3 DetectMissingDatasets.py TCGA-BRCA
 
+The GDC file metadata of each project is cached in '.cache' for 
+CACHE_TTL seconds, so reruns do not request it again. Every cached 
+response that is used is printed and logged. To ignore the cache and 
+request everything again, add '--no-cache'.
+
+Example:
+	python3 DetectMissingDatasets.py TCGA-BRCA --no-cache
+
+Xena hub samples are always requested again by default, so that a dataset 
+that was just imported is seen on the next run. To also cache them, 
+add '--xena-cache'.
+
+Example:
+	python3 DetectMissingDatasets.py TCGA-BRCA --xena-cache
+
 '''
 
 
-import xenaPython as xena
 import pandas as pd
 import requests
-import json
+import orjson
+import csv
+import aiohttp
+import asyncio
+import random
 import xena_dataset 
 import logging
 import time
 from datetime import datetime
 import sys
+import os
+import gzip
+import hashlib
+import tempfile
+from dataclasses import dataclass, field
+from typing import NamedTuple
 
 ###########################Constants###################
 #_XENA_GDC_DTYPE Used as a reference for which files belong to which dataset 
 _XENA_GDC_DTYPE = xena_dataset.GDCOmicset._XENA_GDC_DTYPE
 PROJECT_ENDPT = "https://api.gdc.cancer.gov/projects"
 FILE_ENDPT = "https://api.gdc.cancer.gov/files"
-UNUSED_DATA_TYPE = ["Slide Image", "Biospecimen Supplement", "Clinical Supplement", "Masked Intensities", "Pathology Report", "Isoform Expression Quantification", "Tissue Microarray Image"]
-UNUSED_EXPERIMENTAL_STRATEGY = ["scRNA-Seq"]
-TUMOR_DATA_TYPE = ["Copy Number Segment", "Masked Copy Number Segment", "Gene Level Copy Number", "Masked Somatic Mutation", "Allele-specific Copy Number Segment"]
+UNUSED_DATA_TYPE = frozenset(["Slide Image", "Biospecimen Supplement", "Clinical Supplement", "Masked Intensities", "Pathology Report", "Isoform Expression Quantification", "Tissue Microarray Image"])
+#(data_type, workflow_type) pairs of files that are not imported to the Xena hub
+UNUSED_WORKFLOW = frozenset([("Copy Number Segment", "DNAcopy")])
+UNUSED_EXPERIMENTAL_STRATEGY = frozenset(["scRNA-Seq"])
+TUMOR_DATA_TYPE = frozenset(["Copy Number Segment", "Masked Copy Number Segment", "Gene Level Copy Number", "Masked Somatic Mutation", "Allele-specific Copy Number Segment"])
+#Projects that are compared using the case submitter ID instead of the sample submitter ID
+CASE_SUBMITTER_PROJECTS = frozenset(["CPTAC-3"])
 HUB = "https://gdcbetarelease.xenahubs.net"
 FILE_FIELDS = ["file_id","data_type","analysis.workflow_type","platform", "experimental_strategy", "cases.samples.submitter_id", "cases.samples.tissue_type", "cases.submitter_id"]
 PROJECT_FIELDS = ["project_id", "released"]
+TSV_FILE = "detect_missing_datasets.tsv"
+LOG_FILE = "missing_submitter_ids.json"
+#File metadata used to match a file to a dataset
+MATCH_FIELDS = ["data_type", "workflow_type", "platform", "experimental_strategy"]
+GDC_CACHE_DIR = os.path.join(".cache", "gdc")
+XENA_CACHE_DIR = os.path.join(".cache", "xena")
+#Number of seconds a cached GDC response is used before it is requested again
+CACHE_TTL = 24 * 60 * 60
+#Maximum number of simultaneous connections to the GDC API
+CONCURRENCY = 16
+#Number of files requested from the GDC per page
+PAGE_SIZE = 1000
+#Maximum number of projects tested at the same time
+PROJECT_CONCURRENCY = 8
+#Number of times a GDC request is attempted before giving up on it
+RETRY_ATTEMPTS = 5
+#Xena hub query returning the name and sampleIDs of several datasets. Built from the query xenaPython's 
+#dataset_samples sends for a single dataset.
+XENA_SAMPLES_QUERY = '''(fn [datasets]
+  (query
+    {:select [:dataset.name :value]
+     :from [:dataset]
+     :join [:field [:= :dataset.id :dataset_id]
+            :code [:= :field.id :field_id]]
+     :where [:and [:in :dataset.name datasets]
+                  [:= :field.name "sampleID"]]}))'''
 
 #######################Logging#############################
 start_time = time.time()
-logging.basicConfig(filename = 'missing_submitter_ids.json', level=logging.INFO, format='%(message)s')
+logging.basicConfig(filename = LOG_FILE, level=logging.INFO, format='%(message)s')
 timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 logging.info(f'{timestamp}')
 #######################Global###############
@@ -75,6 +130,8 @@ logging.info(f'{timestamp}')
 Attributes:
 	test (string): This variable contains the project ID when 'test_mode' is True. 
 	test_mode (boolean): True when the script will only run on one project, specified by the user.
+	no_cache (boolean): True when cached GDC and Xena responses are ignored, specified by the '--no-cache' argument.
+	xena_cache (boolean): True when Xena hub samples are cached, specified by the '--xena-cache' argument.
 	project_id_list (list): Where all project IDs of projects that will be run on are contained.
 	missing_submitter_ids(dict): submitter_ids that are missing from the Xena hub are saved here. 
 	Organized by project ID and dataset. Used to form logging file.
@@ -90,9 +147,12 @@ Attributes:
 '''
 test = ''
 test_mode = False
-if len(sys.argv) > 1:
+no_cache = "--no-cache" in sys.argv
+xena_cache = "--xena-cache" in sys.argv
+args = [arg for arg in sys.argv[1:] if arg not in ("--no-cache", "--xena-cache")]
+if len(args) > 0:
 	test_mode = True
-	test = sys.argv[1]
+	test = args[0]
 
 
 project_id_list = []
@@ -103,45 +163,136 @@ total_CDSMS = []
 total_MDT = []
 total_CMDT = []
 missing_submitter_ids = {}
+GDC_SEMAPHORE = asyncio.Semaphore(CONCURRENCY)
+PROJECT_SEMAPHORE = asyncio.Semaphore(PROJECT_CONCURRENCY)
+#Xena hub requests reuse pooled keep-alive connections instead of opening a new one for every dataset
+XENA_SESSION = requests.Session()
+
+async def post_with_retry(session, url, params, attempts = RETRY_ATTEMPTS):
+	'''
+	Posts a request to the GDC API. Requests that are rate limited (status 429), hit a server error (status 5xx), 
+	or fail because of a connection error or timeout are retried with exponential backoff, waiting at least as 
+	long as the GDC's 'Retry-After' header asks for.
+
+	No more than CONCURRENCY requests are sent to the GDC at the same time.
+
+	args:
+		session(aiohttp.ClientSession): The session the request is made with.
+		url(string): The GDC API endpoint the request is posted to.
+		params(dictionary): The body of the request.
+		attempts(int): The number of times the request is attempted before an error is raised.
+	returns:
+		dictionary: JSON-formatted dictionary returned by the GDC API.
+	'''
+	for attempt in range(attempts):
+		delay = 2 ** attempt + random.random()
+		async with GDC_SEMAPHORE:
+			try:
+				async with session.post(url, headers = {"Content-Type": "application/json"}, data = orjson.dumps(params)) as response:
+					if response.status < 500 and response.status != 429:
+						response.raise_for_status()
+						return orjson.loads(await response.read())
+					if attempt == attempts - 1:
+						response.raise_for_status()
+					retry_after = response.headers.get("Retry-After", "")
+					if retry_after.isdigit():
+						delay = max(delay, int(retry_after))
+			except aiohttp.ClientResponseError:
+				#Raised by raise_for_status above, for responses that are not retried
+				raise
+			except (aiohttp.ClientError, asyncio.TimeoutError):
+				if attempt == attempts - 1:
+					raise
+		await asyncio.sleep(delay)
+
+def read_cache(path):
+	'''
+	Reads a response cached by write_cache. Callers return the path of a cache file they used, so that 
+	test_project can report it with the rest of the project's output.
 
-def project_request(fields):
+	args:
+		path(string): The path of the cache file.
+	returns:
+		The cached response, or None if it is not cached, older than CACHE_TTL, cannot be decoded, or the 
+		'--no-cache' argument was given.
+	'''
+	if no_cache or not os.path.exists(path) or time.time() - os.path.getmtime(path) > CACHE_TTL:
+		return None
+	try:
+		with gzip.open(path, "rb") as cache_file:
+			response = orjson.loads(cache_file.read())
+	except (OSError, EOFError, ValueError):
+		return None
+	return response
+
+def report_cache(path):
+	'''
+	Prints and logs that a cached response was used, so that results based on older data can be recognized.
+
+	args:
+		path(string): The path of the cache file that was used.
+	'''
+	saved = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
+	logging.info(f"Using cached response saved {saved}: {path} (add '--no-cache' to request it again)")
+	print(f"Using cached response saved {saved}: {path} (add '--no-cache' to request it again)")
+
+def write_cache(path, response):
 	'''
-	Makes an API call to the GDC for all project IDs in JSON format. Then converts it to a JSON-formmated dictionary.
+	Saves a response to a gzipped JSON file so that it can be read by read_cache on the next run.
+	The file is written to a temporary file first and then moved into place, so an interrupted run 
+	never leaves a partially written cache file behind.
+
+	args:
+		path(string): The path of the cache file.
+		response: The JSON-serializable response that is cached.
+	'''
+	os.makedirs(os.path.dirname(path), exist_ok = True)
+	temp_file = tempfile.NamedTemporaryFile(dir = os.path.dirname(path), suffix = ".tmp", delete = False)
+	try:
+		with temp_file, gzip.open(temp_file, "wb") as cache_file:
+			cache_file.write(orjson.dumps(response))
+		os.replace(temp_file.name, path)
+	except BaseException:
+		os.remove(temp_file.name)
+		raise
+
+async def project_request(session, fields):
+	'''
+	Makes an API call to the GDC for all project IDs in JSON format.
 	
-	This API call is done using a post request and returns in JSON format.
+	This API call is done using an asynchronous post request and returns in JSON format. All metadata is located 
+	in the dictionary corresponding to "data", and the list corresponding to "hits" within that dictionary.
 	args:
+		session(aiohttp.ClientSession): The session the request is made with.
+		fields(list): A list of types of metadata that will be requested from the GDC; currently this 
+		function uses the constant 'PROJECT_FIELDS'.
 
 	returns: 
-		Dictionary: JSON-formatted dictionary that contains all project IDs from the GDC.
+		list: A list that contains dictionaries corresponding to each project's metadata.
 	'''
 
 	filters = {}
 	
 	fields = ",".join(fields)
-	params = {"filters": json.dumps(filters), "fields": fields,
+	params = {"filters": orjson.dumps(filters).decode(), "fields": fields,
 	"format": "json",
 	"size": "100"}
-	response = requests.post(PROJECT_ENDPT,headers = {"Content-Type": "application/json"}, json = params)
-	responseJson = json.dumps(response.json(),indent=2)
+	responseJson = await post_with_retry(session, PROJECT_ENDPT, params)
 
-	return responseJson
+	return responseJson["data"]["hits"]
 
 
 def format_to_list(responseJson):
 	'''
-	This function extracts out the project IDs within the JSON-formatted dictionary returned by the GDC API.
-
-	Since the project IDs are nested in multiple dictionaries and lists, they first need to be "unpeeled". 
-	Only then can they be accessed and appended to a new list. 
+	This function extracts out the project IDs within the list of project metadata returned by the GDC API.
 
 	args:
-		responseJson(dictionary): A dictionary that is created by the return of the GDC API call. 
+		responseJson(list): A list of dictionaries of project metadata returned by project_request. 
 
 	returns:
 		list: List of all project IDs in the GDC.
 
 	'''
-	responseJson = unpeel(responseJson)
 	project_id_list = []
 	for item in responseJson:
 		first_key = next(iter(item))
@@ -149,39 +300,30 @@ def format_to_list(responseJson):
 		project_id_list.append(first_value)
 	return project_id_list
 
-def unpeel(resJson):
-	'''
-	Removes unnecessary dictionaries from the JSON-formatted dictionary returned by the GDC API.
-
-	All metadata is located in the dictionary corresponding to "data", and the list corresponding 
-	to "hits" within that dictionary.
-
-	args:
-		responseJson(dictionary): A dictionary that is created by the return of a GDC API call. 
-	returns:
-		list: A list that contains dictionaries corresponding to each file or project's metadata. (NOT yet a list of metadata)
-	'''
-	resJson = json.loads(resJson)
-	resJson = resJson.get("data")
-	resJson = resJson.get("hits")
-	return resJson
-
-
-def file_request(project_id, fields):
+async def file_request(session, project_id, fields):
 	'''
 	Calls the GDC API for all open access files in a project with the relevant file metadata.
 	
-	This API call is done using a post request and returns in JSON format.
+	This API call is done using asynchronous post requests and returns in JSON format. The files are requested 
+	PAGE_SIZE at a time: the first page gives the number of pages, then the remaining pages are requested at the same time.
+	Files are sorted by file_id so that pages do not overlap, and an error is raised if the pages do not add up to 
+	the total number of files reported by the GDC.
 
 	args:
+		session(aiohttp.ClientSession): The session the request is made with. Shared by all projects.
 		project_id(string): The project_id of the project that you are requesting file metadata for.
 		fields(list): A list of types of metadata that will be requested from the GDC; currently this 
 		function uses the constant 'FILE_FIELDS'.
 	returns:
 		list: A list that contains dictionaries corresponding to each file's metadata. (NOT yet a list of pure metadata)
+		string: The path of the cache file the metadata was read from, or None if it was requested from the GDC.
 
 	'''
 	fields = ",".join(fields)
+	cache_path = os.path.join(GDC_CACHE_DIR, f"{project_id}-{hashlib.sha1(fields.encode()).hexdigest()}.json.gz")
+	responseJson = read_cache(cache_path)
+	if responseJson is not None:
+		return responseJson, cache_path
 	filters = {
 	"op":"and",
 	"content":[
@@ -202,13 +344,42 @@ def file_request(project_id, fields):
 	]
 	
 	}
-	params = {"filters": json.dumps(filters), "fields": fields,
+	params = {"filters": orjson.dumps(filters).decode(), "fields": fields,
 	"format": "json",
-	"size": "100000"}
-	response = requests.post(FILE_ENDPT,headers = {"Content-Type": "application/json"}, json = params)
-	responseJson = json.dumps(response.json(),indent=2)
-	responseJson = unpeel(responseJson)
-	return responseJson
+	"size": str(PAGE_SIZE),
+	"from": "0",
+	"sort": "file_id:asc"}
+	first_page = await post_with_retry(session, FILE_ENDPT, params)
+	page_count = first_page["data"]["pagination"]["pages"]
+	pages = [first_page] + await asyncio.gather(*[post_with_retry(session, FILE_ENDPT, {**params, "from": str(page * PAGE_SIZE)}) for page in range(1, page_count)])
+	responseJson = [file for page in pages for file in page["data"]["hits"]]
+	total = first_page["data"]["pagination"]["total"]
+	if len(responseJson) != total:
+		raise RuntimeError(f"GDC returned {len(responseJson)} files for {project_id}, but reported {total}.")
+	write_cache(cache_path, responseJson)
+	return responseJson, None
+
+
+async def run_projects(test_mode, test, project_id_list, missing_submitter_ids):
+	'''
+	Tests every project, up to PROJECT_CONCURRENCY projects at the same time. Every GDC API call of the script 
+	is made through one session, so that the HTTPS connections to the GDC are kept alive and reused.
+
+	args:
+		test_mode(boolean): A boolean which is true when test mode is on
+		test (string): The project ID of the project that the script is being run on.
+		project_id_list(list): The list of project IDs the script will run on. 
+		missing_submitter_ids(dict): This dictionary is where all submitter IDs missing from Xena will be organized.
+	returns:
+		list: List of all project IDs the script ran through
+		dictionary: A dictionary with no values, but the keys correspond to projects.
+		list of ProjectResult objects: The results of each project, in the same order as the project IDs.
+	'''
+	connector = aiohttp.TCPConnector(limit_per_host = CONCURRENCY)
+	async with aiohttp.ClientSession(connector = connector) as session:
+		project_id_list, missing_submitter_ids = await test_check(session, test_mode, test, project_id_list, missing_submitter_ids)
+		results = await asyncio.gather(*[test_project(session, project_id) for project_id in project_id_list])
+	return project_id_list, missing_submitter_ids, results
 
 
 
@@ -219,14 +390,18 @@ def create_data_set(project_id):
 
 	Each dataset has a set of requirements for a sample to belong in that dataset. These 
 	requirements are contained in '_XENA_GDC_DTYPE'. These requirements then become attributes
-	of each Data_set object
+	of each Data_set object. The datasets are also indexed by their requirements so that files can 
+	be matched to them with dictionary lookups.
 
 	args:
 		project_id(string): The project_id of the project that you are creating datasets for.
 	returns:
 		list of Data_set objects: A list of potential datasets that belong to a project.
+		dictionary: Maps a tuple of a dataset's 'data_type', 'workflow_type', 'platform', and 'experimental_strategy' 
+		requirements to the dataset's position in the list and the dataset. Missing requirements are "".
 	'''
 	data_set_list = []
+	data_set_index = {}
 	for key, value in _XENA_GDC_DTYPE.items():
 		data_type = ''
 		workflow_type = ''
@@ -241,126 +416,112 @@ def create_data_set(project_id):
 		if 'experimental_strategy' in value:
 			experimental_strategy = value["experimental_strategy"]
 		data_set = Data_set(key, data_type,workflow_type, platform, experimental_strategy, project_id)
+		requirements = (data_set.data_type, data_set.workflow_type, data_set.platform, data_set.experimental_strategy)
+		data_set_index.setdefault(requirements, (len(data_set_list), data_set))
 		data_set_list.append(data_set)
-	return data_set_list
+	return data_set_list, data_set_index
+
+def use_file(data_type, workflow_type, experimental_strategy):
+	'''
+	Checks if a file is of a type that is imported to the Xena hub.
 
-def file_metadata(file_list, data_set_list, project_id, missing_file_list):
+	args:
+		data_type(string): The data type of the file.
+		workflow_type(string): The workflow type of the file.
+		experimental_strategy(string): The experimental strategy of the file.
+	returns:
+		boolean: True if the file is used, False if it is thrown out.
+	'''
+	return data_type not in UNUSED_DATA_TYPE and (data_type, workflow_type) not in UNUSED_WORKFLOW and experimental_strategy not in UNUSED_EXPERIMENTAL_STRATEGY
+
+def file_metadata(file_list, data_set_index, project_id, missing_file_list):
 	'''
-	This function takes in the list of file metadata returned by the GDC API and creates a File object 
-	for each file. Then each file is organized to a dataset, placed into a missing datatype list, or 
-	thrown out depending on its metadata. 
+	This function takes in the list of file metadata returned by the GDC API and collects the metadata of 
+	each used file into a DataFrame. Files are then grouped by the metadata used for matching, so each 
+	distinct combination is matched to a dataset once instead of once per file. The files of each group 
+	are added to the columns of that dataset, or become File objects placed into a missing datatype list. 
 
 	args:
 		file_list(list): list where each element is a dictionary of one file's metadata. Returned from the 
 		GDC API in JSON format.
-		data_set_list(list of Data_set objects): A list of potential data sets in a project.
-		project_id(string): The project_id of the project you are organizing files for. Only used to
-		check if the project is "CPTAC-3", a special case. 
+		data_set_index(dictionary): The potential data sets in a project, indexed by their requirements.
+		project_id(string): The project_id of the project you are organizing files for. Used to check 
+		if the project is in CASE_SUBMITTER_PROJECTS, a special case. 
+		missing_file_list(list of File objects): list of files which do not belong in any of the potential datasets
+	returns:
 		missing_file_list(list of File objects): list of files which do not belong in any of the potential datasets
-
 
 	'''
+	rows = []
+	use_case_submitter = project_id in CASE_SUBMITTER_PROJECTS
 	for file in file_list:
 
 		file_id = file["file_id"]
 
-		submitter_id = ''
-		data_type = ''
-		workflow_type = ''
-		platform = ''
-		experimental_strategy = ''
-		if "data_type" in file:
-			data_type = file["data_type"]
-		if "analysis" in file:
-			workflow_type = file["analysis"]["workflow_type"]
-		if 'platform' in file:
-			platform = file["platform"]
-		if 'experimental_strategy' in file:
-			experimental_strategy = file["experimental_strategy"]
-		if project_id == "CPTAC-3":
-			if not (data_type in UNUSED_DATA_TYPE) and not ((data_type == "Copy Number Segment") and (workflow_type == "DNAcopy" )) and not(experimental_strategy in UNUSED_EXPERIMENTAL_STRATEGY):
-				sample_info = file["cases"][0]["samples"]
-				
-				if data_type in TUMOR_DATA_TYPE:
-					for i in range(len(sample_info)):
-						if sample_info[i]["tissue_type"] == "Tumor":	
-							submitter_id = file["cases"][0]["submitter_id"]
-							break
-				else:
-					submitter_id = file["cases"][0]["submitter_id"]
-		elif not (data_type in UNUSED_DATA_TYPE) and not ((data_type == "Copy Number Segment") and (workflow_type == "DNAcopy")) and not(experimental_strategy in UNUSED_EXPERIMENTAL_STRATEGY):
-			sample_info = file["cases"][0]["samples"]
-			if data_type in TUMOR_DATA_TYPE:
-				for i in range(len(sample_info)):
-					if sample_info[i]["tissue_type"] == "Tumor":	
-						submitter_id = sample_info[i]["submitter_id"]
-						break
-			else:
-				submitter_id = sample_info[0]["submitter_id"]
+		#Fields that are missing or null are treated as ''
+		data_type = file.get("data_type") or ''
+		workflow_type = (file.get("analysis") or {}).get("workflow_type") or ''
+		platform = file.get("platform") or ''
+		experimental_strategy = file.get("experimental_strategy") or ''
+		if not use_file(data_type, workflow_type, experimental_strategy):
+			continue
+
+		case = file["cases"][0]
+		sample_info = case["samples"]
+		if data_type in TUMOR_DATA_TYPE:
+			sample_info = [sample for sample in sample_info if sample["tissue_type"] == "Tumor"]
+			if len(sample_info) == 0:
+				continue
+		if use_case_submitter:
+			submitter_id = case["submitter_id"]
+		else:
+			submitter_id = sample_info[0]["submitter_id"]
 							
 		if len(submitter_id) > 0:
-			file = File(file_id, data_type, workflow_type, platform, experimental_strategy, submitter_id, data_set_list[0].project_id)
-			missing_file_list = match_to_data_set(missing_file_list, data_set_list,file)
+			rows.append((file_id, data_type, workflow_type, platform, experimental_strategy, submitter_id))
+
+	file_df = pd.DataFrame(rows, columns = ["file_id"] + MATCH_FIELDS + ["submitter_id"])
+	for key, files in file_df.groupby(MATCH_FIELDS, sort = False, dropna = False):
+		key = ClassifyKey(*key)
+		data_set = match_to_data_set(data_set_index, *key)
+		if data_set is None:
+			missing_file_list.extend(File(key, file_id, submitter_id, project_id) for file_id, submitter_id in zip(files["file_id"], files["submitter_id"]))
+		else:
+			data_set.keys.extend([key] * len(files))
+			data_set.file_ids.extend(files["file_id"])
+			data_set.submitter_ids.extend(files["submitter_id"])
 	return missing_file_list
 			
 				
 		
 		
 
-def match_to_data_set(missing_file_list, data_set_list, file):
+def match_to_data_set(data_set_index, data_type, workflow_type, platform, experimental_strategy):
 	'''
-	This function matches an individual file to a dataset by checking if its metadata matches the requirements of the dataset.
-	If a file does not match any, it goes into the missing_file_list.
+	This function matches file metadata to a dataset by checking if it matches the requirements of the dataset.
+	A dataset without a requirement accepts any value for it, so the requirements a file can match are its 
+	metadata with every combination of fields replaced by "". Each combination is looked up in data_set_index, 
+	and the match that comes first in '_XENA_GDC_DTYPE' is used. The requirements of each dataset are already 
+	lowercase, so the metadata is lowercased once here rather than once per comparison.
 
 	args:
-		missing_file_list(list of File objects): list of files which do not belong in any of the potential datasets
-		data_set_list(list of Data_set objects): A list of potential data sets in a project.
-		file(File object): A File object that contains its relevant metadata.
+		data_set_index(dictionary): The potential data sets in a project, indexed by their requirements.
+		data_type(string): The data type of the files.
+		workflow_type(string): The workflow type of the files.
+		platform(string): The platform of the files.
+		experimental_strategy(string): The experimental strategy of the files.
 	returns:
-		missing_file_list(list of File objects): list of files which do not belong in any of the potential datasets
+		Data_set object: The dataset the files belong to, or None if they do not belong in any of the potential datasets.
 	'''
-	missing = True
-	for data_set in data_set_list:
-		match_count = 0
-		if (data_set.data_type == "") or (data_set.data_type.lower() == file.data_type.lower()):
-			match_count+=1
-		if (data_set.workflow_type =="") or (data_set.workflow_type.lower() == file.workflow_type.lower()):
-			match_count+=1
-		if (data_set.platform == "") or (data_set.platform.lower() == file.platform.lower()):
-			match_count+=1
-		if (data_set.experimental_strategy == "") or (data_set.experimental_strategy.lower() == file.experimental_strategy.lower()):
-			match_count+=1
-		
-		
-		if match_count == 4:
-			
-			data_set.files.append(file)
-			missing = False
-			return missing_file_list
-			
-	if missing:
-		missing_file_list.append(file)		
-		return missing_file_list
-
-
-
-def remove_missing_duplicates(missing_file_list):
-	'''
-	This function removes duplicate files which have the same attributes. Note: When comparing two File objects, 
-	it compares their attributes.
-
-	args:
-		missing_file_list(list of File objects): list of files which do not belong in any of the potential datasets 
-		as well as those which are part of a dataset that doesn't exist in the Xena hub. 
-	returns:
-		list: set of file attributes. Each element is a unique file, with its metadata joined with a "/".
-	'''
-	unique_list = list(set(missing_file_list))
-	for i in range(len(unique_list)):
-		temp_list = [unique_list[i].data_type, unique_list[i].workflow_type, unique_list[i].platform, unique_list[i].experimental_strategy]
-		temp_list = [s for s in temp_list if len(s) > 0]
-		unique_list[i] = "/".join(temp_list)
-	return unique_list
+	metadata = (data_type.lower(), workflow_type.lower(), platform.lower(), experimental_strategy.lower())
+	matches = []
+	for mask in range(2 ** len(metadata)):
+		requirements = tuple(value if mask >> i & 1 else "" for i, value in enumerate(metadata))
+		if requirements in data_set_index:
+			matches.append(data_set_index[requirements])
+	if len(matches) == 0:
+		return None
+	return min(matches, key = lambda match: match[0])[1]
 
 
 
@@ -375,26 +536,41 @@ def prune_data_sets(data_set_list):
 	'''
 	pruned_list = []
 	for data_set in data_set_list:
-		if len(data_set.files) > 0:
+		if len(data_set.submitter_ids) > 0:
 			pruned_list.append(data_set)
 	return pruned_list
 
 
-def xena_dataset(data_set):
+def xena_datasets(data_set_list):
 	'''
-	This function calls the xena API for a list of sample submitter IDs that belong to a specific dataset
+	This function calls the xena API for the sample submitter IDs of every dataset of a project with a single query.
+	Results are only cached, in the same way as the GDC file metadata, when the '--xena-cache' argument is given.
 
 	args:
-		data_set(Data_set object): A data set that the function will use to call the Xena API with.
+		data_set_list(list of Data_set objects): The data sets that the function will use to call the Xena API with.
 	returns:
-		list: A list of submitter IDs of the samples of the dataset. 
-	'''
-	elements = [data_set.project_id, data_set.name,"tsv"]
-	data_set_id = ".".join(elements)
-	
-	samples = xena.dataset_samples(HUB, data_set_id, None)
-
-	return samples
+		list: One list of submitter IDs of the samples per dataset, in the same order as data_set_list. 
+		Datasets that do not exist on the Xena hub have an empty list.
+		string: The path of the cache file the samples were read from, or None if they were requested from the Xena hub.
+	'''
+	data_set_ids = [".".join([data_set.project_id, data_set.name,"tsv"]) for data_set in data_set_list]
+	if len(data_set_ids) == 0:
+		return [], None
+	cache_path = os.path.join(XENA_CACHE_DIR, f"{data_set_list[0].project_id}-{hashlib.sha1(','.join(data_set_ids).encode()).hexdigest()}.json.gz")
+	samples = read_cache(cache_path) if xena_cache else None
+	if samples is not None:
+		return [samples[data_set_id] for data_set_id in data_set_ids], cache_path
+
+	query = f"({XENA_SAMPLES_QUERY} {orjson.dumps(data_set_ids).decode()})"
+	response = XENA_SESSION.post(HUB + "/data/", headers = {"Content-Type": "text/plain"}, data = query.encode())
+	response.raise_for_status()
+	samples = {data_set_id: [] for data_set_id in data_set_ids}
+	for row in orjson.loads(response.content):
+		samples[row["name"]].append(row["value"])
+	if xena_cache:
+		write_cache(cache_path, samples)
+
+	return [samples[data_set_id] for data_set_id in data_set_ids], None
 
 def compare_datasets(samples, missing_file_list, data_set):
 	'''
@@ -412,8 +588,8 @@ def compare_datasets(samples, missing_file_list, data_set):
 	'''
 	if len(samples) == 0:
 		
-		for file in data_set.files:
-			missing_file_list.append(file)
+		for key, file_id, submitter_id in zip(data_set.keys, data_set.file_ids, data_set.submitter_ids):
+			missing_file_list.append(File(key, file_id, submitter_id, data_set.project_id))
 		return True, missing_file_list
 	return False, missing_file_list
 	
@@ -432,21 +608,15 @@ def compare_samples(samples, data_set, project_id):
 		list: The third variable is a list which returns the list of submitter IDs missing from the GDC side.
 
 	'''
-	submitter_id_list = []
+	submitter_id_list = pd.Index(data_set.submitter_ids, dtype = object)
 	if project_id == "BEATAML1.0-COHORT":
-		for file in data_set.files:
-			submitter_id_list.append(file.submitter_id[:-1])
-	else:
-		for file in data_set.files:
-			submitter_id_list.append(file.submitter_id)
+		submitter_id_list = submitter_id_list.str[:-1]
 
 	
-	submitter_id_list = set(submitter_id_list)
-	samples = set(samples)
-	missing_ids = submitter_id_list - samples
-	missing_ids_GDC_dtype = samples - submitter_id_list
-	missing_ids = list(missing_ids)
-	missing_ids_GDC_dtype = list(missing_ids_GDC_dtype)
+	submitter_id_list = submitter_id_list.unique()
+	samples = pd.Index(samples, dtype = object).unique()
+	missing_ids = submitter_id_list.difference(samples).tolist()
+	missing_ids_GDC_dtype = samples.difference(submitter_id_list).tolist()
 	logging.info(f"sample Count Xena: {len(samples)}")
 	logging.info(f"sample Count GDC: {len(submitter_id_list)}")
 	logging.info(f"sample Count that Xena is missing: {len(missing_ids)}")
@@ -468,9 +638,9 @@ def compare_samples(samples, data_set, project_id):
 
 def to_tsv(total_CMDS, total_MDS, total_CDSMS, total_DSMS, total_CMDT, total_MDT, project_id_list):
 	'''
-	This function creates a TSV file called "detect_missing_datasets.tsv" using the columns: "#_missing_datasets",
+	This function creates a TSV file called "detect_missing_datasets.tsv" using the columns: "project_id", "#_missing_datasets",
 	 "missing_datasets", "#_datasets_with_wrong_sampleN", "datasets_with_wrong_sampleN", "#_missing_datatypes", 
-	"missing_datatypes". The rows of this file are indexed by project ID. 
+	"missing_datatypes". Each row is one project. Lists of datasets and datatypes are joined with a ";". 
 
 	args:
 		Each element corresponds to a project for the below lists.
@@ -482,35 +652,44 @@ def to_tsv(total_CMDS, total_MDS, total_CDSMS, total_DSMS, total_CMDT, total_MDT
 		total_MDT(list): list of the datatypes missing from the Xena hub.
 		project_id_list(list): project IDs of projects that were tested when this script ran
 	'''
-	dataset_dict = {"#_missing_datasets": total_CMDS, 
-		"missing_datasets": total_MDS, 
-		"#_datasets_with_wrong_sampleN": total_CDSMS,
-		"datasets_with_wrong_sampleN": total_DSMS,
-		"#_missing_datatypes": total_CMDT,
-		"missing_datatypes": total_MDT}
-	dataset_df = pd.DataFrame(dataset_dict, index =project_id_list)
-	dataset_df.to_csv("detect_missing_datasets.tsv", sep="\t", index=True)
+	header = ["project_id", "#_missing_datasets", "missing_datasets", "#_datasets_with_wrong_sampleN", 
+		"datasets_with_wrong_sampleN", "#_missing_datatypes", "missing_datatypes"]
+	rows = zip(project_id_list, total_CMDS, map(";".join, total_MDS), total_CDSMS, map(";".join, total_DSMS), 
+		total_CMDT, map(";".join, total_MDT))
 	logging.info("\n")
 	print("\n")
-	print(dataset_df)
-	print("\nDataset Dataframe saved to tsv file: detect_missing_datasets.tsv")
+	with open(TSV_FILE, "w", newline = "") as tsv_file:
+		writer = csv.writer(tsv_file, delimiter = "\t", lineterminator = "\n")
+		writer.writerow(header)
+		print("\t".join(header))
+		for row in rows:
+			writer.writerow(row)
+			print("\t".join(map(str, row)))
+	print(f"\nDataset table saved to tsv file: {TSV_FILE}")
 
 def to_logging(missing_submitter_ids):
 	'''
 	Adds to the logging file all of the sample submitter IDs that were missing from the Xena hub or GDC, organized 
-	by project and dataset.
+	by project and dataset. Each project is written as its own line of JSON directly to the file, rather than 
+	formatting the whole dictionary at once and passing it through the logging module.
 
 	args:
 		missing_submitter_ids (dictionary): Contains all submitter IDs that were missing from the Xena hub or GDC.
 	'''
 
-	logging.info(json.dumps(missing_submitter_ids, indent=2))
-	print("\nmissing_submitter_ids dictionary saved using logging module. File name: missing_submitter_ids.json")
+	for handler in logging.getLogger().handlers:
+		handler.flush()
+	with open(LOG_FILE, "ab") as log_file:
+		for project_id, missing_ids in missing_submitter_ids.items():
+			log_file.write(orjson.dumps({project_id: missing_ids}))
+			log_file.write(b"\n")
+	print(f"\nmissing_submitter_ids dictionary saved to logging file. File name: {LOG_FILE}")
 
-def test_check(test_mode, test, project_id_list,missing_submitter_ids):
+async def test_check(session, test_mode, test, project_id_list,missing_submitter_ids):
 	'''
 	This functions checks if the script is going to run one project or all projects.
 	args: 
+		session(aiohttp.ClientSession): The session the GDC API call for all project IDs is made with.
 		test_mode(boolean): A boolean which is true when test mode is on
 		test (string): The project ID of the project that the script is being run on.
 		project_id_list(list): The list of project IDs the script will run on. 
@@ -523,7 +702,7 @@ def test_check(test_mode, test, project_id_list,missing_submitter_ids):
 	if test_mode:
 		project_id_list = [test]
 	else:
-		project_id_list = project_request(PROJECT_FIELDS)
+		project_id_list = await project_request(session, PROJECT_FIELDS)
 
 		project_id_list = format_to_list(project_id_list)
 		
@@ -531,75 +710,82 @@ def test_check(test_mode, test, project_id_list,missing_submitter_ids):
 	return project_id_list, missing_submitter_ids
 
 
+@dataclass(slots = True, eq = False)
 class Data_set:
 	# This class acts as a storage of metadata on a Dataset. Including its requirements, project Id, and the files that belong to it.
-	
-
-	def __init__(self,name, data_type, workflow_type, platform, experimental_strategy, project_id):
-		self.data_type = data_type
-		self.workflow_type = workflow_type
-		self.platform = platform
-		self.project_id = project_id
-		self.name = name
-		self.experimental_strategy = experimental_strategy
-		self.files = []
-
-	def add_file(file):
-		files.append(file)
+	# The requirements are stored lowercase since matching is case insensitive. The files are stored as columns, where 
+	# the same position in 'keys', 'file_ids', and 'submitter_ids' is the same file.
+	name: str
+	data_type: str
+	workflow_type: str
+	platform: str
+	experimental_strategy: str
+	project_id: str
+	keys: list = field(default_factory = list)
+	file_ids: list = field(default_factory = list)
+	submitter_ids: list = field(default_factory = list)
+
+	def __post_init__(self):
+		self.data_type = self.data_type.lower()
+		self.workflow_type = self.workflow_type.lower()
+		self.platform = self.platform.lower()
+		self.experimental_strategy = self.experimental_strategy.lower()
+
+class ClassifyKey(NamedTuple):
+	# The metadata used to match a file to a dataset.
+	data_type: str
+	workflow_type: str
+	platform: str
+	experimental_strategy: str
+
+@dataclass(slots = True)
+class ProjectResult:
+	# This class acts as a storage of the results of testing one project, used to form the TSV and logging files.
+	names_MDS: list
+	names_DSMS: list
+	unique_list: list
+	missing_ids: dict
+
+@dataclass(frozen = True, slots = True)
 class File:
 	# This class acts as a storage of metadata on a File, including its submitter_id, project_id, and metadata used to match a file to a dataset. 
-	def __init__(self, file_id, data_type, workflow_type, platform,experimental_strategy ,submitter_id, project_id):
-		self.data_type = data_type
-		self.workflow_type = workflow_type
-		self.platform = platform
-		self.project_id = project_id
-		self.file_id = file_id
-		self.experimental_strategy = experimental_strategy
-		self.submitter_id = submitter_id
-
-	def __eq__(self, other):
-		if not isinstance(other, File):
-			return NotImplemented
-		return self.data_type == other.data_type and self.workflow_type == other.workflow_type and self.platform == other.platform and self.experimental_strategy == other.experimental_strategy
-
-	def __hash__(self):
-		return hash((self.data_type, self.workflow_type, self.platform, self.experimental_strategy))
-
-
-
-def test_project(project_id, 
-	missing_submitter_ids, 
-	total_CMDS,
-	total_MDS,
-	total_CDSMS,
-	total_DSMS,
-	total_CMDT,
-	total_MDT):
+	# Two files are equal when their metadata used for matching is equal.
+	key: ClassifyKey
+	file_id: str = field(compare = False)
+	submitter_id: str = field(compare = False)
+	project_id: str = field(compare = False)
+
+
+
+async def test_project(session, project_id):
 	'''
 	This function runs the file request to GDC and organizes them to correct datasets. Then it runs sample requests to Xena, and compares the submitter IDs of both.
 
+	All requests are awaited before anything is printed or logged. Since the rest of the function never awaits, 
+	the output of a project is not interleaved with the output of other projects running at the same time.
+
 	args:
+		session(aiohttp.ClientSession): The session the GDC API calls are made with. Shared by all projects.
 		project_id (string): The project ID of the project that the function is running through.
-		missing_submitter_ids (dictionary): submitter_ids that are missing from the Xena hub are saved here. Organized by project ID and dataset. 
-		Used to form logging file
-
-		Below variables used to form TSV file. Each element represents the data for one project
-		total_MDS(list):Datasets missing from the Xena hub. 
-		total_CMDS (list): # of datasets missing from the Xena hub.
-		total_DSMS (list): Datasets that are missing samples.
-		total_CDSMS (list): # of datasets that are missing samples.
-		total_MDT (list): Datatypes that are missing from the Xena hub.
-		total_CMDT (list): # of datatypes that are missing from the Xena hub. 
+	returns:
+		ProjectResult object: The missing datasets, datasets missing samples, missing datatypes, and missing 
+		submitter IDs of the project.
 
 	'''
+	async with PROJECT_SEMAPHORE:
+		file_list, gdc_cache_path = await file_request(session, project_id, FILE_FIELDS)
+		missing_file_list = []
+		data_set_list, data_set_index = create_data_set(project_id)
+		missing_file_list=  file_metadata(file_list, data_set_index, project_id, missing_file_list)
+		data_set_list = prune_data_sets(data_set_list)
+		sample_lists, xena_cache_path = await asyncio.to_thread(xena_datasets, data_set_list)
+
 	logging.info(f"Project ID: {project_id} \n")
 	print(f"Project ID: {project_id} \n")
+	for cache_path in (gdc_cache_path, xena_cache_path):
+		if cache_path is not None:
+			report_cache(cache_path)
 
-	file_list = file_request(project_id, FILE_FIELDS)
-	missing_file_list = []
-	data_set_list = create_data_set(project_id)
-	missing_file_list=  file_metadata(file_list, data_set_list, project_id, missing_file_list)
-	data_set_list = prune_data_sets(data_set_list)
 	logging.info(f"Number of samples which don't match any Xena data types: {len(missing_file_list)} \n")
 	print(f"Number of samples which don't match any Xena data types: {len(missing_file_list)} \n")
 
@@ -609,13 +795,11 @@ def test_project(project_id,
 	missing_ids_GDC = {data_set.name: None for data_set in data_set_list}
 
 
-	for data_set in data_set_list:
+	for data_set, samples in zip(data_set_list, sample_lists):
 		
 		logging.info(f" \ndata type: {data_set.name}")
 		print(f"\ndata type: {data_set.name}")
 
-		samples = xena_dataset(data_set)
-
 		isTrue ,missing_file_list = compare_datasets(samples, missing_file_list, data_set)
 		
 		if isTrue:
@@ -627,15 +811,16 @@ def test_project(project_id,
 		missing_ids_GDC[data_set.name] = missing_ids_GDC_dtype
 
 
-	unique_list = []
-	if len(missing_file_list) != 0:
-		unique_list = remove_missing_duplicates(missing_file_list)
-	for value in range(len(missing_file_list)):
-		missing_file_list[value] = missing_file_list[value].submitter_id
-	missing_file_list = list(set(missing_file_list))
+	#Unique missing data types and submitter IDs are collected in one pass over the missing files
+	unique_keys = set()
+	unique_submitter_ids = set()
+	for file in missing_file_list:
+		unique_keys.add(file.key)
+		unique_submitter_ids.add(file.submitter_id)
+	unique_list = ["/".join(s for s in key if len(s) > 0) for key in unique_keys]
+	missing_file_list = list(unique_submitter_ids)
 	missing_ids["not_in_datasets"] = missing_file_list
 	missing_ids["not_in_GDC"] = missing_ids_GDC
-	missing_submitter_ids[project_id] = missing_ids
 
 	logging.info(f"\nnumber of unique samples missing from datasets: {len(missing_file_list)}")
 	logging.info(f"missing data types: {unique_list}")
@@ -658,20 +843,19 @@ def test_project(project_id,
 		names_DSMS.append(item.name)
 
 
-
-	total_MDS.append(names_MDS)
-	total_CMDS.append(len(names_MDS))
-	total_DSMS.append(names_DSMS)
-	total_CDSMS.append(len(names_DSMS))
-	total_CMDT.append(len(unique_list))
-	total_MDT.append(unique_list)
+	return ProjectResult(names_MDS, names_DSMS, unique_list, missing_ids)
 
 
 #Script runs in below lines.
-project_id_list, missing_submitter_ids = test_check(test_mode, test, project_id_list,missing_submitter_ids)
-for project_id in project_id_list:
-	
-	test_project(project_id, missing_submitter_ids, total_CMDS,total_MDS,total_CDSMS,total_DSMS,total_CMDT,total_MDT)
+project_id_list, missing_submitter_ids, results = asyncio.run(run_projects(test_mode, test, project_id_list,missing_submitter_ids))
+for project_id, result in zip(project_id_list, results):
+	total_MDS.append(result.names_MDS)
+	total_CMDS.append(len(result.names_MDS))
+	total_DSMS.append(result.names_DSMS)
+	total_CDSMS.append(len(result.names_DSMS))
+	total_CMDT.append(len(result.unique_list))
+	total_MDT.append(result.unique_list)
+	missing_submitter_ids[project_id] = result.missing_ids
 
 to_tsv(total_CMDS, total_MDS, total_CDSMS, total_DSMS, total_CMDT, total_MDT, project_id_list)
 to_logging(missing_submitter_ids)